@@ -1,18 +1,13 @@
+import os
 import pathlib
 import sys
 
 sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.parent.parent))
 
+# Quiet tensorflow's C++ logging; has to be set before tensorflow is first imported
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+
 from absl import app
-import tensorflow as tf
-from urnai.agents.actions.sc2_wrapper import SimpleTerranWrapper
-from urnai.agents.rewards.sc2 import KilledUnitsReward
-from urnai.agents.sc2_agent import SC2Agent
-from urnai.agents.states.sc2 import TVTUnitStackingState
-from urnai.envs.sc2 import SC2Env
-from urnai.models.algorithms.ddql import DoubleDeepQLearning
-from urnai.models.model_builder import ModelBuilder
-from urnai.trainers.trainer import Trainer
 
 
 """
@@ -24,11 +19,23 @@ For more information see https://github.com/deepmind/pysc2#get-starcraft-ii
 # os.environ['SC2PATH'] = 'D:/Program Files (x86)/StarCraft II'
 
 
-physical_devices = tf.config.list_physical_devices('GPU')
-tf.config.experimental.set_memory_growth(physical_devices[0], True)
-
-
 def declare_trainer():
+    # tensorflow, pysc2 and the urnai modules built on top of them are heavy imports,
+    # so they are kept at function scope and only paid when the trainer actually runs
+    import tensorflow as tf
+    from urnai.agents.actions.sc2_wrapper import SimpleTerranWrapper
+    from urnai.agents.rewards.sc2 import KilledUnitsReward
+    from urnai.agents.sc2_agent import SC2Agent
+    from urnai.agents.states.sc2 import TVTUnitStackingState
+    from urnai.envs.sc2 import SC2Env
+    from urnai.models.algorithms.ddql import DoubleDeepQLearning
+    from urnai.models.model_builder import ModelBuilder
+    from urnai.trainers.trainer import Trainer
+
+    physical_devices = tf.config.list_physical_devices('GPU')
+    if physical_devices:
+        tf.config.experimental.set_memory_growth(physical_devices[0], True)
+
     env = SC2Env(map_name='Simple64', render=False, step_mul=16, player_race='terran',
                  enemy_race='terran', difficulty='very_easy')
 
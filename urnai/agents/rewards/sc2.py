@@ -42,19 +42,28 @@ class GeneralReward(RewardBuilder):
         self.last_killed_structures_score = 0
 
     def get_reward(self, obs, reward, done):
+        # read each observation field once into a local: this runs every step, and
+        # the repeated pysc2 namedtuple attribute lookups add up over a training run
+        player = obs.player
+        score = obs.score_cumulative
+        food_army = player.food_army
+        food_workers = player.food_workers
+        structures_score = score.total_value_structures
+        killed_units_score = score.killed_value_units
+        killed_structures_score = score.killed_value_structures
+
         currentscore = -1
-        currentscore += (obs.player.food_army - self.last_own_army_count) * 50
-        currentscore += (obs.player.food_workers - self.last_own_worker_count) * 25
-        currentscore += obs.score_cumulative.total_value_structures - self.last_structures_score
-        currentscore += (obs.score_cumulative.killed_value_units - self.last_killed_units_score)
-        currentscore += (obs.score_cumulative.killed_value_structures -
-                         self.last_killed_structures_score) * 2
-
-        self.last_own_army_count = obs.player.food_army
-        self.last_own_worker_count = obs.player.food_workers
-        self.last_killed_units_score = obs.score_cumulative.killed_value_units
-        self.last_killed_structures_score = obs.score_cumulative.killed_value_structures
-        self.last_structures_score = obs.score_cumulative.total_value_structures
+        currentscore += (food_army - self.last_own_army_count) * 50
+        currentscore += (food_workers - self.last_own_worker_count) * 25
+        currentscore += structures_score - self.last_structures_score
+        currentscore += killed_units_score - self.last_killed_units_score
+        currentscore += (killed_structures_score - self.last_killed_structures_score) * 2
+
+        self.last_own_army_count = food_army
+        self.last_own_worker_count = food_workers
+        self.last_killed_units_score = killed_units_score
+        self.last_killed_structures_score = killed_structures_score
+        self.last_structures_score = structures_score
 
         self.reward = currentscore
 
@@ -82,15 +91,19 @@ class KilledUnitsReward(RewardBuilder):
         self._previous_killed_building_score = 0
 
     def get_reward(self, obs, reward, done):
+        # read both score fields once into locals, avoiding the repeated pysc2
+        # namedtuple attribute lookups on this per-step path
+        score = obs.score_cumulative
+        killed_unit_score = score.killed_value_units
+        killed_building_score = score.killed_value_structures
 
         new_reward = 0
 
-        new_reward += (obs.score_cumulative.killed_value_units - self._previous_killed_unit_score)
-        new_reward += (
-                obs.score_cumulative.killed_value_structures - self._previous_killed_building_score)
+        new_reward += killed_unit_score - self._previous_killed_unit_score
+        new_reward += killed_building_score - self._previous_killed_building_score
 
-        self._previous_killed_unit_score = obs.score_cumulative.killed_value_units
-        self._previous_killed_building_score = obs.score_cumulative.killed_value_structures
+        self._previous_killed_unit_score = killed_unit_score
+        self._previous_killed_building_score = killed_building_score
 
         if done:
             self.reset()
@@ -1,9 +1,7 @@
-import random
-
 import numpy
 from urnai.agents.actions.base.abwrapper import ActionWrapper
 from urnai.agents.states.abstate import StateBuilder
-from urnai.models.algorithms.dql import DeepQLearning
+from urnai.models.algorithms.dql import build_target_q_values, DeepQLearning
 from urnai.models.memory_representations.neural_network.nnfactory import NeuralNetworkFactory
 
 
@@ -182,15 +180,10 @@ class DoubleDeepQLearning(DeepQLearning):
 
     def memory_learn(self, s, a, r, s_, done):
         self.memorize(s, a, r, s_, done)
-        if len(self.memory) < self.min_memory_size:
+        if self.memory_size < self.min_memory_size:
             return
 
-        batch = random.sample(self.memory, self.batch_size)
-        states = numpy.array([val[0] for val in batch])
-        states = numpy.squeeze(states)
-        next_states = numpy.array([(numpy.zeros(self.state_size)
-                                    if val[3] is None else val[3]) for val in batch])
-        next_states = numpy.squeeze(next_states)
+        states, actions, rewards, next_states, dones = self.sample_batch()
 
         # predict Q(s,a) given the batch of states
         q_s_a = self.dnn.get_output(states)
@@ -198,22 +191,12 @@ class DoubleDeepQLearning(DeepQLearning):
         # predict Q(s',a') - so that we can do gamma * max(Q(s'a')) below
         q_s_a_d = self.target_dnn.get_output(next_states)
 
-        # setup training arrays
-        target_q_values = numpy.zeros((len(batch), self.action_size))
-
-        for i, (state, action, reward, next_state, done) in enumerate(batch):
-            # get the current q values for all actions in state
-            current_q = numpy.copy(q_s_a[i])
-            if done:
-                # if this is the last step, there is no future max q value,
-                # so we the new_q is just the reward
-                current_q[action] = reward
-            else:
-                # new Q-value is equal to the reward at that step + discount factor * the
-                # max q-value for the next_state
-                current_q[action] = reward + self.gamma * numpy.amax(q_s_a_d[i])
-
-            target_q_values[i] = current_q
+        # new Q-value is equal to the reward at each step + discount factor * the max
+        # q-value for the next_state. For terminal steps there is no future max q value,
+        # so the new Q-value is just the reward. Computed for the whole minibatch in a
+        # single pass by the (optionally numba-compiled) TD-target kernel.
+        target_q_values = build_target_q_values(q_s_a, q_s_a_d, actions, rewards, dones,
+                                                self.gamma)
 
         # update neural network with expected q values
         self.dnn.update(states, target_q_values)
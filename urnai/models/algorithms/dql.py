@@ -1,4 +1,3 @@
-from collections import deque
 import random
 
 from agents.actions.base.abwrapper import ActionWrapper
@@ -7,6 +6,42 @@ from models.base.abmodel import LearningModel
 from models.memory_representations.neural_network.nnfactory import NeuralNetworkFactory
 import numpy
 
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def build_target_q_values(q_s_a, q_s_a_d, actions, rewards, dones, gamma):
+        """
+        TD-target kernel: fuses the max-reduction over next-state q-values, the
+        discounted-reward multiply-add and the scatter into the target array into a
+        single pass over the minibatch, compiled by numba.
+        """
+        batch_size, action_size = q_s_a.shape
+        target_q_values = q_s_a.copy()
+        for i in prange(batch_size):
+            max_next_q = q_s_a_d[i, 0]
+            for j in range(1, action_size):
+                if q_s_a_d[i, j] > max_next_q:
+                    max_next_q = q_s_a_d[i, j]
+            if dones[i]:
+                target_q_values[i, actions[i]] = rewards[i]
+            else:
+                target_q_values[i, actions[i]] = rewards[i] + gamma * max_next_q
+        return target_q_values
+else:
+    def build_target_q_values(q_s_a, q_s_a_d, actions, rewards, dones, gamma):
+        """Vectorized numpy fallback of the TD-target kernel, for when numba is absent."""
+        max_next_q = numpy.amax(q_s_a_d, axis=1)
+        targets = rewards + gamma * max_next_q * (1.0 - dones.astype(numpy.float32))
+        target_q_values = numpy.copy(q_s_a)
+        target_q_values[numpy.arange(q_s_a.shape[0]), actions] = targets
+        return target_q_values
+
 
 class DeepQLearning(LearningModel):
     """
@@ -160,11 +195,31 @@ class DeepQLearning(LearningModel):
                                                          self.batch_size)
 
         self.dnn.get_device()
+
+        # Single-entry cache for the allowed-actions list used when choosing a random
+        # action: exclusion sets are usually stable over many consecutive steps, so the
+        # filtered list can be reused instead of being rebuilt every step.
+        self._allowed_actions = None
+        self._allowed_actions_key = None
+
         self.use_memory = use_memory
         if self.use_memory:
-            self.memory = deque(maxlen=memory_maxlen)
             self.memory_maxlen = memory_maxlen
             self.min_memory_size = min_memory_size
+            # Replay memory lives in one preallocated structured array, written through
+            # a circular index: each transition is a single contiguous record, so
+            # memorize() is one record write and sampling a minibatch is one gather,
+            # instead of five separate buffer accesses per transition.
+            self.memory_dtype = numpy.dtype([
+                ('state', numpy.float32, (self.state_size,)),
+                ('action', numpy.int32),
+                ('reward', numpy.float32),
+                ('next_state', numpy.float32, (self.state_size,)),
+                ('done', numpy.bool_),
+            ])
+            self.memory = numpy.empty(memory_maxlen, dtype=self.memory_dtype)
+            self.memory_size = 0
+            self.memory_write_idx = 0
 
     def learn(self, s, a, r, s_, done):
         if self.use_memory:
@@ -180,38 +235,24 @@ class DeepQLearning(LearningModel):
 
     def memory_learn(self, s, a, r, s_, done):
         self.memorize(s, a, r, s_, done)
-        if len(self.memory) < self.min_memory_size:
+        if self.memory_size < self.min_memory_size:
             return
 
-        batch = random.sample(self.memory, self.batch_size)
-        states = numpy.array([val[0] for val in batch])
-        states = numpy.squeeze(states)
-        next_states = numpy.array([(numpy.zeros(self.state_size)
-                                    if val[3] is None else val[3]) for val in batch])
-        next_states = numpy.squeeze(next_states)
-
-        # predict Q(s,a) given the batch of states
-        q_s_a = self.dnn.get_output(states)
-
-        # predict Q(s',a') - so that we can do gamma * max(Q(s'a')) below
-        q_s_a_d = self.dnn.get_output(next_states)
-
-        # setup training arrays
-        target_q_values = numpy.zeros((len(batch), self.action_size))
-
-        for i, (state, action, reward, next_state, done) in enumerate(batch):
-            # get the current q values for all actions in state
-            current_q = numpy.copy(q_s_a[i])
-            if done:
-                # if this is the last step, there is no future max q value, so we the new_q
-                # is just the reward
-                current_q[action] = reward
-            else:
-                # new Q-value is equal to the reward at that step + discount factor * the
-                # max q-value for the next_state
-                current_q[action] = reward + self.gamma * numpy.amax(q_s_a_d[i])
+        states, actions, rewards, next_states, dones = self.sample_batch()
+
+        # predict Q(s,a) for the batch of states and Q(s',a') for the batch of
+        # next_states with a single forward pass over their concatenation, paying
+        # one dispatch into the ML backend instead of two
+        q_all = self.dnn.get_output(numpy.concatenate((states, next_states), axis=0))
+        q_s_a = q_all[:self.batch_size]
+        q_s_a_d = q_all[self.batch_size:]
 
-            target_q_values[i] = current_q
+        # new Q-value is equal to the reward at each step + discount factor * the max
+        # q-value for the next_state. For terminal steps there is no future max q value,
+        # so the new Q-value is just the reward. Computed for the whole minibatch in a
+        # single pass by the (optionally numba-compiled) TD-target kernel.
+        target_q_values = build_target_q_values(q_s_a, q_s_a_d, actions, rewards, dones,
+                                                self.gamma)
 
         # update neural network with expected q values
         self.dnn.update(states, target_q_values)
@@ -222,6 +263,9 @@ class DeepQLearning(LearningModel):
         # cols = self.action_size
         # target_q_values = numpy.zeros(shape=(rows, cols))
 
+        # cast once at the env boundary: states built from python lists default to
+        # float64, which doubles the bytes shipped into the ML backend
+        s = numpy.asarray(s, dtype=numpy.float32)
         q_s_a = self.dnn.get_output(s)
 
         expected_q = 0
@@ -235,7 +279,7 @@ class DeepQLearning(LearningModel):
         self.dnn.update(s, q_s_a)
 
     def __maxq(self, state):
-        values = self.dnn.get_output(state)
+        values = self.dnn.get_output(numpy.asarray(state, dtype=numpy.float32))
         mxq = values.max()
         return mxq
 
@@ -243,31 +287,66 @@ class DeepQLearning(LearningModel):
         if is_testing:
             return self.predict(state, excluded_actions)
         else:
-            if numpy.random.rand() <= self.epsilon_greedy:
-                random_action = random.choice(self.actions)
-
+            # random.random() instead of numpy.random.rand() here: for a single scalar
+            # draw the numpy dispatch overhead is pure waste on this per-step path
+            if random.random() <= self.epsilon_greedy:
                 # Removing excluded actions
-                while random_action in excluded_actions:
-                    random_action = random.choice(self.actions)
-                return random_action
+                if excluded_actions:
+                    excluded_key = tuple(excluded_actions)
+                    if excluded_key != self._allowed_actions_key:
+                        excluded_set = set(excluded_actions)
+                        self._allowed_actions = [action for action in self.actions
+                                                 if action not in excluded_set]
+                        self._allowed_actions_key = excluded_key
+                    allowed_actions = self._allowed_actions
+                else:
+                    allowed_actions = self.actions
+                return random.choice(allowed_actions)
             else:
                 return self.predict(state, excluded_actions)
 
     def predict(self, state, excluded_actions=[]):
-        q_values = self.dnn.get_output(state)
-        action_idx = numpy.argmax(q_values)
+        state = numpy.asarray(state, dtype=numpy.float32)
+        q_values = self.dnn.get_output(state).ravel()
 
-        # Removing excluded actions
-        # TODO: This is possibly badly optimized, eventually look back into this
-        while action_idx in excluded_actions:
-            q_values = numpy.delete(q_values, action_idx)
-            action_idx = numpy.argmax(q_values)
+        # Removing excluded actions by masking their q-values out before the argmax,
+        # instead of repeatedly deleting entries from the array
+        if excluded_actions:
+            q_values = q_values.copy()
+            q_values[numpy.asarray(excluded_actions, dtype=numpy.intp)] = -numpy.inf
 
-        action = int(action_idx)
+        action = int(numpy.argmax(q_values))
         return action
 
     def memorize(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))
+        # terminal transitions carry no next_state; the current state is stored in its
+        # place, since the TD-target kernel already drops the bootstrap term for done
+        # transitions and a real row keeps the batched forward pass well-formed
+        if next_state is None:
+            next_state = state
+
+        record = self.memory[self.memory_write_idx]
+        record['state'] = numpy.reshape(state, -1)
+        record['action'] = action
+        record['reward'] = reward
+        record['next_state'] = numpy.reshape(next_state, -1)
+        record['done'] = done
+
+        self.memory_write_idx = (self.memory_write_idx + 1) % self.memory_maxlen
+        if self.memory_size < self.memory_maxlen:
+            self.memory_size += 1
+
+    def sample_batch(self):
+        """
+        Gathers a random minibatch of transition records from the replay memory,
+        returning it as a (states, actions, rewards, next_states, dones) tuple of
+        numpy arrays. The state arrays are made contiguous since they are handed
+        straight to the ML backend.
+        """
+        idx = numpy.random.randint(0, self.memory_size, size=self.batch_size)
+        batch = self.memory[idx]
+        return (numpy.ascontiguousarray(batch['state']), batch['action'], batch['reward'],
+                numpy.ascontiguousarray(batch['next_state']), batch['done'])
 
     def save_extra(self, persist_path):
         self.dnn.save(persist_path)
@@ -1,11 +1,9 @@
-from collections import deque
-import os
 import random
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.compat.v1 import ConfigProto, global_variables_initializer, layers, placeholder, \
-    Session, train
+from tensorflow.compat.v1 import AUTO_REUSE, ConfigProto, global_variables_initializer, \
+    layers, OptimizerOptions, placeholder, Session, train
 from tensorflow.python.framework import ops
 from urnai.agents.actions.base.abwrapper import ActionWrapper
 from urnai.agents.states.abstate import StateBuilder
@@ -38,9 +36,18 @@ class DqlTensorFlow(LearningModel):
 
         self.use_memory = use_memory
         if self.use_memory:
-            self.memory = deque(maxlen=memory_maxlen)
+            # a list with manual circular eviction instead of a deque: deques are not
+            # O(1) indexable, so random.sample walks the whole queue on every step,
+            # while sampling from a list only touches the k chosen entries
+            self.memory = []
+            self.memory_write_idx = 0
             self.memory_maxlen = memory_maxlen
             self.min_memory_size = min_memory_size
+            # Preallocated minibatch buffers, refilled in-place on every training
+            # step instead of rebuilding (and squeezing) fresh arrays from lists
+            self._state_batch = np.empty((batch_size, self.state_size), dtype=np.float32)
+            self._next_state_batch = np.empty((batch_size, self.state_size),
+                                              dtype=np.float32)
 
     def learn(self, s, a, r, s_, done):
         if self.use_memory:
@@ -54,77 +61,62 @@ class DqlTensorFlow(LearningModel):
             return
 
         batch = random.sample(self.memory, self.batch_size)
-        states = np.array([val[0] for val in batch])
-        states = np.squeeze(states)
-        next_states = np.array([(np.zeros(self.state_size)
-                                 if val[3] is None else val[3]) for val in batch])
-        next_states = np.squeeze(next_states)
-        # predict Q(s,a) given the batch of states
-        q_s_a = self.sess.run(self.model_layers[-1], feed_dict={self.model_layers[0]: states})
-
-        # predict Q(s',a') - so that we can do gamma * max(Q(s'a')) below
-        q_s_a_d = self.sess.run(self.model_layers[-1],
-                                feed_dict={self.model_layers[0]: next_states})
-
-        # setup training arrays
-        x = np.zeros((len(batch), self.state_size))
-        y = np.zeros((len(batch), self.action_size))
+        states = self._state_batch
+        next_states = self._next_state_batch
+        for i, transition in enumerate(batch):
+            states[i] = np.reshape(transition[0], -1)
+            if transition[3] is None:
+                next_states[i] = 0
+            else:
+                next_states[i] = np.reshape(transition[3], -1)
+
+        # predict Q(s',a') - so that we can do gamma * max(Q(s'a')) below; the masked
+        # loss only needs the TD targets, so no forward pass on the current states
+        q_s_a_d = self._forward(next_states)
+
+        # setup training arrays: a one-hot mask of the chosen actions plus their
+        # scalar TD targets, as expected by the masked loss
+        action_mask = np.zeros((len(batch), self.action_size), dtype=np.float32)
+        q_targets = np.empty(len(batch), dtype=np.float32)
 
         for i, (state, action, reward, next_state, done) in enumerate(batch):
-            # get the current q values for all actions in state
-            current_q = q_s_a[i]
             if done:
                 # if this is the last step, there is no future max q value, so we
                 # the new_q is just the reward
-                current_q[action] = reward
+                q_targets[i] = reward
             else:
                 # new Q-value is equal to the reward at that step + discount factor *
                 # the max q-value for the next_state
-                current_q[action] = reward + self.gamma * np.amax(q_s_a_d[i])
+                q_targets[i] = reward + self.gamma * np.amax(q_s_a_d[i])
 
-            x[i] = state
-            y[i] = current_q
+            action_mask[i, action] = 1.0
 
-        self.sess.run(self.optimizer, feed_dict={self.model_layers[0]: x, self.tf_qsa: y})
+        self._train_batch(states, action_mask, q_targets)
 
     def no_memory_learn(self, s, a, r, s_, done):
-        qsa_values = self.sess.run(self.model_layers[-1], feed_dict={self.model_layers[0]: s})
-
-        current_q = 0
-
-        if done:
-            current_q = r
-        else:
-            current_q = r + self.gamma * self.__maxq(s_)
-
-        qsa_values[0, a] = current_q
-
-        self.sess.run(self.optimizer, feed_dict={self.model_layers[0]: s, self.tf_qsa: qsa_values})
-
-    def __maxq(self, state):
-        values = self.sess.run(self.model_layers[-1], feed_dict={self.model_layers[0]: state})
-
-        index = np.argmax(values[0])
-        mxq = values[0, index]
-
-        return mxq
+        # for terminal transitions the state is fed twice and the done flag zeroes
+        # the bootstrap term in-graph, keeping the fed batch a fixed 2-row shape
+        pair = np.concatenate((s, s if done else s_), axis=0)
+        self._train_single(pair, a, r, 1.0 if done else 0.0)
 
     def choose_action(self, state, excluded_actions=[], is_testing=False):
         if is_testing:
             return self.predict(state, excluded_actions)
 
         else:
-            expl_expt_tradeoff = np.random.rand()
+            # scalar draw from python's random: cheaper than a numpy dispatch per step
+            expl_expt_tradeoff = random.random()
             action = None
 
             if self.epsilon_greedy > expl_expt_tradeoff:
-                # ex_int = self.actions[random.randint(0, len(self.actions) - 1)]
-                random_action = random.choice(self.actions)
-
                 # Removing excluded actions
-                while random_action in excluded_actions:
-                    random_action = random.choice(self.actions)
-                action = random_action
+                if excluded_actions:
+                    excluded_set = set(excluded_actions)
+                    allowed_actions = [act for act in self.actions
+                                       if act not in excluded_set]
+                else:
+                    allowed_actions = self.actions
+                action = random.choice(allowed_actions)
             else:
                 action = self.predict(state, excluded_actions)
 
@@ -134,16 +126,15 @@ class DqlTensorFlow(LearningModel):
             return action
 
     def predict(self, state, excluded_actions=[]):
-        q_values = self.sess.run(self.model_layers[-1], feed_dict={self.model_layers[0]: state})
-        action_idx = np.argmax(q_values)
+        q_values = self._forward_single(state).ravel()
 
-        # Removing excluded actions
-        # This is possibly badly optimized, eventually look back into this
-        while action_idx in excluded_actions:
-            q_values = np.delete(q_values, action_idx)
-            action_idx = np.argmax(q_values)
+        # Removing excluded actions by masking their q-values out before the argmax,
+        # instead of repeatedly deleting entries from the array
+        if excluded_actions:
+            q_values = q_values.copy()
+            q_values[np.asarray(excluded_actions, dtype=np.intp)] = -np.inf
 
-        action = int(action_idx)
+        action = int(np.argmax(q_values))
         return action
 
     def save_extra(self, persist_path):
@@ -153,11 +144,12 @@ class DqlTensorFlow(LearningModel):
     def load_extra(self, persist_path):
         # Makes model, needed to be done before loading tensorflow's persistance
         self.make_model()
-        # Check if tf file exists
-        exists = os.path.isfile(self.get_full_persistance_tensorflow_path(persist_path) + '.meta')
-        # If yes, load it
-        if exists:
-            self.saver.restore(self.sess, self.get_full_persistance_tensorflow_path(persist_path))
+        checkpoint_path = self.get_full_persistance_tensorflow_path(persist_path)
+        # Only restore when a checkpoint actually exists: checkpoint_exists covers
+        # sharded checkpoints that an isfile check on the .meta file would miss, and
+        # skipping the restore avoids paying tensorflow's exception path on first run
+        if train.checkpoint_exists(checkpoint_path):
+            self.saver.restore(self.sess, checkpoint_path)
             self.set_seed()
 
     def make_model(self):
@@ -165,8 +157,12 @@ class DqlTensorFlow(LearningModel):
         ops.reset_default_graph()
         tf.compat.v1.disable_eager_execution()
 
-        # Initializing TensorFlow session
-        self.sess = Session(config=ConfigProto(allow_soft_placement=True))
+        # Initializing TensorFlow session with XLA cluster compilation turned on,
+        # so chains of small dense layers get fused into a single kernel instead
+        # of paying one launch per op.
+        config = ConfigProto(allow_soft_placement=True)
+        config.graph_options.optimizer_options.global_jit_level = OptimizerOptions.ON_1
+        self.sess = Session(config=config)
 
         if self.build_model[0]['type'] == ModelBuilder.LAYER_INPUT \
                 and self.build_model[-1]['type'] == ModelBuilder.LAYER_OUTPUT:
@@ -174,38 +170,100 @@ class DqlTensorFlow(LearningModel):
             self.build_model[-1]['length'] = self.action_size
 
         # Load each layer
-        self.model_layers = []
+        self.model_layers = self._build_layers()
+
+        # A second, batch-1 specialized view of the same network for the inference
+        # path: predict() always feeds a single state, and a fixed [1, state_size]
+        # input shape lets XLA compile a fully shape-specialized kernel for it
+        # instead of keeping dynamic-batch dispatch logic around.
+        self.inputs_single = placeholder(dtype=tf.float32, shape=[1, self.state_size],
+                                         name='inputs_single')
+        self.output_single = self._build_layers(model_input=self.inputs_single)[-1]
+
+        # Setup masked loss: only the chosen action's output enters the error term,
+        # so backprop works on a scalar prediction per sample instead of also
+        # materializing zero gradients for every untouched action output
+        adam = train.AdamOptimizer(self.learning_rate)
+        self.tf_action_mask = placeholder(shape=[None, self.action_size], dtype=tf.float32)
+        self.tf_q_target = placeholder(shape=[None], dtype=tf.float32)
+        predicted_q = tf.reduce_sum(self.model_layers[-1] * self.tf_action_mask, axis=1)
+        self.loss = tf.reduce_mean(tf.square(predicted_q - self.tf_q_target))
+        self.optimizer = adam.minimize(self.loss)
+
+        # Single-transition training path: fed a 2-row batch [state; next_state], so
+        # the forward pass on the current state and the max-Q pass on the next state
+        # share one session call. The TD target is assembled in-graph from the reward
+        # and done flags and compared against the chosen action's output, meaning
+        # learning from one transition costs exactly one session call.
+        self.tf_action_index = placeholder(shape=[], dtype=tf.int32)
+        self.tf_reward = placeholder(shape=[], dtype=tf.float32)
+        self.tf_done = placeholder(shape=[], dtype=tf.float32)
+        max_next_q = tf.reduce_max(self.model_layers[-1][1])
+        td_target = self.tf_reward + self.gamma * (1.0 - self.tf_done) * max_next_q
+        action_mask_single = tf.one_hot(self.tf_action_index, self.action_size)
+        predicted_q_single = tf.reduce_sum(self.model_layers[-1][0] * action_mask_single)
+        self.loss_single = tf.square(predicted_q_single - tf.stop_gradient(td_target))
+        self.optimizer_single = adam.minimize(self.loss_single)
+
+        # self.logits = layers.dense(self.model_layers[-1], self.action_size)
+        # self._states = placeholder(shape=[None, self.state_size], dtype=tf.float32)
+
+        self.sess.run(global_variables_initializer())
+
+        self.saver = train.Saver()
+
+        # Precompiled session callables for the per-step paths: make_callable skips
+        # the feed_dict parsing and tensor-name lookups that sess.run pays on every
+        # call, which matters when these run once per environment step.
+        self._forward = self.sess.make_callable(self.model_layers[-1],
+                                                feed_list=[self.model_layers[0]])
+        self._train_batch = self.sess.make_callable(
+            self.optimizer,
+            feed_list=[self.model_layers[0], self.tf_action_mask, self.tf_q_target])
+        self._train_single = self.sess.make_callable(
+            self.optimizer_single,
+            feed_list=[self.model_layers[0], self.tf_action_index, self.tf_reward,
+                       self.tf_done])
+        self._forward_single = self.sess.make_callable(self.output_single,
+                                                       feed_list=[self.inputs_single])
+
+    def _build_layers(self, model_input=None):
+        """
+        Builds the dense layers described by self.build_model on top of model_input,
+        or on a new input placeholder when none is given. Layer variables are created
+        by the first call and shared with every subsequent call through AUTO_REUSE.
+        """
+        model_layers = []
         for layer_model in self.build_model:
             if layer_model['type'] == ModelBuilder.LAYER_INPUT:
                 if self.build_model.index(layer_model) == 0:
-                    self.model_layers.append(placeholder(dtype=tf.float32,
-                                                         shape=layer_model['shape'],
-                                                         name='inputs_'))
+                    if model_input is None:
+                        model_input = placeholder(dtype=tf.float32,
+                                                  shape=layer_model['shape'],
+                                                  name='inputs_')
+                    model_layers.append(model_input)
                 else:
                     raise IncoherentBuildModelError('Input Layer must be the first one.')
             elif layer_model['type'] == ModelBuilder.LAYER_FULLY_CONNECTED:
-                self.model_layers.append(layers.dense(inputs=self.model_layers[-1],
-                                                      units=layer_model['nodes'],
-                                                      activation=tf.nn.relu,
-                                                      name=layer_model['name']))
+                model_layers.append(layers.dense(inputs=model_layers[-1],
+                                                 units=layer_model['nodes'],
+                                                 activation=tf.nn.relu,
+                                                 name=layer_model['name'],
+                                                 reuse=AUTO_REUSE))
             elif layer_model['type'] == ModelBuilder.LAYER_OUTPUT:
-                self.model_layers.append(layers.dense(inputs=self.model_layers[-1],
-                                                      units=self.action_size, activation=None))
+                model_layers.append(layers.dense(inputs=model_layers[-1],
+                                                 units=self.action_size, activation=None,
+                                                 name='output', reuse=AUTO_REUSE))
             else:
                 raise UnsupportedBuildModelLayerTypeError(
                     'Unsuported Layer Type ' + layer_model['type'])
 
-        # Setup output qsa layer and loss
-        self.tf_qsa = placeholder(shape=[None, self.action_size], dtype=tf.float32)
-        self.loss = tf.losses.mean_squared_error(self.tf_qsa, self.model_layers[-1])
-        self.optimizer = train.AdamOptimizer(self.learning_rate).minimize(self.loss)
-
-        # self.logits = layers.dense(self.model_layers[-1], self.action_size)
-        # self._states = placeholder(shape=[None, self.state_size], dtype=tf.float32)
-
-        self.sess.run(global_variables_initializer())
-
-        self.saver = train.Saver()
+        return model_layers
 
     def memorize(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))
+        transition = (state, action, reward, next_state, done)
+        if len(self.memory) >= self.memory_maxlen:
+            self.memory[self.memory_write_idx] = transition
+        else:
+            self.memory.append(transition)
+        self.memory_write_idx = (self.memory_write_idx + 1) % self.memory_maxlen